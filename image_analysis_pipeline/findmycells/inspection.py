@@ -1,19 +1,37 @@
 from abc import ABC, abstractmethod
 import os
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import lru_cache, partial
 import numpy as np
-import matplotlib.pyplot as plt
-from PIL import Image
-from skimage import measure
+from scipy.ndimage import binary_dilation, center_of_mass, find_objects
+from skimage import draw, measure
 from skimage.io import imread, imsave
-from shapely.geometry import Polygon
-import cc3d
 
 from typing import Dict, List, Tuple, Optional, Union
 
 from .database import Database
 from .utils import load_zstack_as_array_from_single_planes, get_polygon_from_instance_segmentation, get_cropping_box_arround_centroid
-from .utils import get_color_code, get_rgb_color_code_for_3D, listdir_nohidden
+from .utils import get_color_code, get_rgb_color_code_for_3D, get_label_counts_per_plane, listdir_nohidden
+
+
+def load_and_scan_postprocessed_segmentation(path: Path, file_id: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # the modification times of all single plane files are part of the cache key, so that re-computed segmentations are not served from the cache
+    plane_files = tuple((filename, path.joinpath(filename).stat().st_mtime_ns) for filename in sorted(listdir_nohidden(path)) if filename.startswith(file_id))
+    return load_and_scan_postprocessed_segmentation_cached(path = path, file_id = file_id, plane_files = plane_files)
+
+
+@lru_cache(maxsize = 1)
+def load_and_scan_postprocessed_segmentation_cached(path: Path, file_id: str, plane_files: Tuple) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # cached, since all label indices of the same area roi & file id share this zstack - the arrays are therefore made read-only.
+    # Only the most recently used zstack is kept, as inspections iterate over all label indices of one area roi & file id before moving on.
+    # It stays in memory until another zstack is inspected (or its plane files change) - i.e. the last inspected zstack is kept for the session.
+    zstack = load_zstack_as_array_from_single_planes(path = path, file_id = file_id).astype('uint16', copy = False)
+    label_ids, label_counts = get_label_counts_per_plane(zstack = zstack)
+    for array in [zstack, label_ids, label_counts]:
+        array.flags.writeable = False
+    return zstack, label_ids, label_counts
+
 
 
 class InspectionObject:
@@ -24,30 +42,23 @@ class InspectionObject:
         self.area_roi_id = area_roi_id
         self.show = show
         self.save = save
-        self.zstack = self.load_postprocessed_segmentation()
+        self.zstack, self.label_ids, self.label_counts = self.load_postprocessed_segmentation()
         self.label_id = self.get_label_id(index = label_index)
         self.plane_id = self.get_plane_id()
         
-    def load_postprocessed_segmentation(self) -> np.ndarray:
+    def load_postprocessed_segmentation(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
         path = self.database.quantified_segmentations_dir.joinpath(self.area_roi_id)
-        return load_zstack_as_array_from_single_planes(path = path, file_id = self.file_id)
+        return load_and_scan_postprocessed_segmentation(path = path, file_id = self.file_id)
     
     
     def get_label_id(self, index: int) -> int:
-        label_ids = list(np.unique(self.zstack))
-        for background_id in [0, 0.0]:
-            if background_id in label_ids:
-                label_ids.remove(background_id)
-        return label_ids[index]
+        return int(self.label_ids[index])
     
     
     def get_plane_id(self) -> int:
-        all_planes_with_label_id = list(np.where(self.zstack == self.label_id)[0])
-        if len(all_planes_with_label_id) > 1:
-            plane_id = all_planes_with_label_id[int(len(all_planes_with_label_id) / 2)]
-        else:
-            plane_id = all_planes_with_label_id[0]
-        return plane_id
+        # plane of the median pixel of label_id (all pixels ordered by plane index)
+        label_counts = self.label_counts[:, np.searchsorted(self.label_ids, self.label_id)]
+        return int(np.searchsorted(np.cumsum(label_counts), label_counts.sum() // 2, side = 'right'))
         
 
     def run_all_inspection_steps(self) -> None:
@@ -68,40 +79,89 @@ class InspectionStrategy(ABC):
 class InspectReconstructedCells2D(InspectionStrategy):
     
     def run(self, inspection_object: InspectionObject):
+        cropped_window = self.get_cropped_window(inspection_object = inspection_object)
+        self.inspect_cropped_window(cropped_window = cropped_window)
+
+
+    def run_batch(self, inspection_objects: List[InspectionObject]) -> None:
+        # batch entry point to inspect many labels (e.g. all label indices of an area roi) at once. 
+        # Inspections that are only saved run in parallel processes, since matplotlib is not thread-safe, 
+        # while plots that shall be shown have to be created in the main process. The workers only receive
+        # the cropped windows, not the InspectionObjects with their full zstacks.
+        cropped_windows_to_save = [self.get_cropped_window(inspection_object = elem) for elem in inspection_objects if not elem.show]
+        if len(cropped_windows_to_save) > 0:
+            with ProcessPoolExecutor(max_workers = min(os.cpu_count() or 1, len(cropped_windows_to_save))) as executor:
+                list(executor.map(partial(self.inspect_cropped_window, parallel_loading = False), cropped_windows_to_save))
+        for inspection_object in inspection_objects:
+            if inspection_object.show:
+                self.run(inspection_object = inspection_object)
+
+
+    def get_cropped_window(self, inspection_object: InspectionObject) -> Dict:
         cminx, cmaxx, cminy, cmaxy = self.get_cropping_indices(inspection_object = inspection_object)
-        cropped_zstack = inspection_object.zstack.copy()
-        cropped_zstack = cropped_zstack[:, cminx:cmaxx, cminy:cmaxy]
-        plotting_info = self.get_plotting_info(zstack = cropped_zstack)
-        cropped_preprocessed_zstack = load_zstack_as_array_from_single_planes(path = inspection_object.database.preprocessed_images_dir, 
-                                                                              file_id = inspection_object.file_id, 
-                                                                              minx = cminx, 
-                                                                              maxx = cmaxx, 
-                                                                              miny = cminy, 
-                                                                              maxy = cmaxy)
-        cropped_instance_seg_zstack = load_zstack_as_array_from_single_planes(path = inspection_object.database.instance_segmentations_dir, 
-                                                                              file_id = inspection_object.file_id, 
-                                                                              minx = cminx, 
-                                                                              maxx = cmaxx, 
-                                                                              miny = cminy, 
-                                                                              maxy = cmaxy)
-        filepath = inspection_object.database.inspected_area_plots_dir.joinpath(f'{inspection_object.file_id}_{inspection_object.area_roi_id}_{inspection_object.label_id}_2D.png')
-        if inspection_object.show:
-            print(f'Plot to inspect segmentation of label #{inspection_object.label_id} in area roi id {inspection_object.area_roi_id} of file id #{inspection_object.file_id}:')
-        self.plot_reconstructed_cells(preprocessed_zstack = cropped_preprocessed_zstack, 
-                                      instance_seg_zstack = cropped_instance_seg_zstack, 
-                                      final_labels_zstack = cropped_zstack, 
-                                      plotting_info = plotting_info, 
-                                      plane_id_of_interest = inspection_object.plane_id,
-                                      filepath = filepath,
-                                      save = inspection_object.save,
-                                      show = inspection_object.show)
+        cropped_window = {'preprocessed_images_dir': inspection_object.database.preprocessed_images_dir,
+                          'instance_segmentations_dir': inspection_object.database.instance_segmentations_dir,
+                          'file_id': inspection_object.file_id,
+                          'area_roi_id': inspection_object.area_roi_id,
+                          'label_id': inspection_object.label_id,
+                          'plane_id': inspection_object.plane_id,
+                          'cropping_indices': (cminx, cmaxx, cminy, cmaxy),
+                          'cropped_zstack': inspection_object.zstack[:, cminx:cmaxx, cminy:cmaxy],
+                          'filepath': inspection_object.database.inspected_area_plots_dir.joinpath(f'{inspection_object.file_id}_{inspection_object.area_roi_id}_{inspection_object.label_id}_2D.png'),
+                          'show': inspection_object.show,
+                          'save': inspection_object.save}
+        return cropped_window
+
+
+    def inspect_cropped_window(self, cropped_window: Dict, parallel_loading: bool=True) -> None:
+        cminx, cmaxx, cminy, cmaxy = cropped_window['cropping_indices']
+        paths = [cropped_window['preprocessed_images_dir'], cropped_window['instance_segmentations_dir']]
+        if parallel_loading:
+            with ThreadPoolExecutor(max_workers = 2) as executor:
+                loadings = [executor.submit(load_zstack_as_array_from_single_planes, 
+                                            path = path, 
+                                            file_id = cropped_window['file_id'], 
+                                            minx = cminx, 
+                                            maxx = cmaxx, 
+                                            miny = cminy, 
+                                            maxy = cmaxy) for path in paths]
+                plotting_info = self.get_plotting_info(zstack = cropped_window['cropped_zstack'])
+                cropped_preprocessed_zstack, cropped_instance_seg_zstack = [loading.result() for loading in loadings]
+        else:
+            plotting_info = self.get_plotting_info(zstack = cropped_window['cropped_zstack'])
+            cropped_preprocessed_zstack, cropped_instance_seg_zstack = [load_zstack_as_array_from_single_planes(path = path, 
+                                                                                                                file_id = cropped_window['file_id'], 
+                                                                                                                minx = cminx, 
+                                                                                                                maxx = cmaxx, 
+                                                                                                                miny = cminy, 
+                                                                                                                maxy = cmaxy,
+                                                                                                                max_workers = 1) for path in paths]
+        if cropped_window['show']:
+            print(f'Plot to inspect segmentation of label #{cropped_window["label_id"]} in area roi id {cropped_window["area_roi_id"]} of file id #{cropped_window["file_id"]}:')
+        if cropped_window['save'] and not cropped_window['show']:
+            self.save_reconstructed_cells_as_image(preprocessed_zstack = cropped_preprocessed_zstack, 
+                                                   instance_seg_zstack = cropped_instance_seg_zstack, 
+                                                   final_labels_zstack = cropped_window['cropped_zstack'], 
+                                                   plotting_info = plotting_info, 
+                                                   plane_id_of_interest = cropped_window['plane_id'],
+                                                   filepath = cropped_window['filepath'])
+        else:
+            self.plot_reconstructed_cells(preprocessed_zstack = cropped_preprocessed_zstack, 
+                                          instance_seg_zstack = cropped_instance_seg_zstack, 
+                                          final_labels_zstack = cropped_window['cropped_zstack'], 
+                                          plotting_info = plotting_info, 
+                                          plane_id_of_interest = cropped_window['plane_id'],
+                                          filepath = cropped_window['filepath'],
+                                          save = cropped_window['save'],
+                                          show = cropped_window['show'])
         
         
     def get_cropping_indices(self, inspection_object: InspectionObject) -> Tuple[int, int, int, int]:
         half_window_size = 200
-        roi = get_polygon_from_instance_segmentation(single_plane = inspection_object.zstack[inspection_object.plane_id], label_id = inspection_object.label_id)
-        centroid_x, centroid_y = round(roi.centroid.x), round(roi.centroid.y)
-        max_x, max_y = inspection_object.zstack[inspection_object.plane_id].shape[0], inspection_object.zstack[inspection_object.plane_id].shape[1]
+        plane = inspection_object.zstack[inspection_object.plane_id]
+        centroid_x, centroid_y = center_of_mass(plane == inspection_object.label_id)
+        centroid_x, centroid_y = round(centroid_x), round(centroid_y)
+        max_x, max_y = plane.shape
         cminx, cmaxx = self.adjust_cropping_box_to_image_borders(centroid_coord = centroid_x, max_value = max_x, half_window_size = half_window_size)
         cminy, cmaxy = self.adjust_cropping_box_to_image_borders(centroid_coord = centroid_y, max_value = max_y, half_window_size = half_window_size)
         return cminx, cmaxx, cminy, cmaxy
@@ -124,60 +184,51 @@ class InspectReconstructedCells2D(InspectionStrategy):
         
         
     def get_plotting_info(self, zstack: np.ndarray) -> Dict:
-        label_ids = list(np.unique(zstack))
-        if 0 in label_ids:
-            label_ids.remove(0)
-        if 0.0 in label_ids:
-            label_ids.remove(0)
+        label_ids, label_counts = get_label_counts_per_plane(zstack = zstack)
         color_code = get_color_code(label_ids)
         z_dim, x_dim, y_dim = zstack.shape
         plotting_info = dict()
         for plane_index in range(z_dim):
             plotting_info[plane_index] = dict()
-        for label_id in label_ids:
-            for plane_index in range(z_dim):
-                if label_id in np.unique(zstack[plane_index]):
-                    roi = get_polygon_from_instance_segmentation(zstack[plane_index], label_id) 
-                    boundary_x_coords, boundary_y_coords = np.asarray(roi.boundary.xy[0]), np.asarray(roi.boundary.xy[1])
-                    plotting_info[plane_index][label_id] = {'color': color_code[label_id],
-                                                            'boundary_x_coords': boundary_x_coords,
-                                                            'boundary_y_coords': boundary_y_coords} 
+            bounding_boxes = find_objects(zstack[plane_index])
+            for label_id in label_ids[label_counts[plane_index] > 0]:
+                # trace the boundary only within the bounding box of the label (plus 1 px margin, so that it is traced like in the whole plane)
+                row_slice, col_slice = bounding_boxes[label_id - 1]
+                min_row, min_col = max(row_slice.start - 1, 0), max(col_slice.start - 1, 0)
+                label_mask = zstack[plane_index, min_row:row_slice.stop + 1, min_col:col_slice.stop + 1] == label_id
+                boundary = measure.find_contours(label_mask, level = 0.5)[0]
+                boundary_x_coords, boundary_y_coords = boundary[:, 0] + min_row, boundary[:, 1] + min_col
+                plotting_info[plane_index][label_id] = {'color': color_code[label_id],
+                                                        'boundary_x_coords': boundary_x_coords,
+                                                        'boundary_y_coords': boundary_y_coords} 
         return plotting_info            
 
         
     def plot_reconstructed_cells(self, preprocessed_zstack: np.ndarray, instance_seg_zstack: np.ndarray, 
                                  final_labels_zstack: np.ndarray, plotting_info: Dict, plane_id_of_interest: int, 
                                  filepath: Path, save: bool, show: bool) -> None:
+        # matplotlib is only imported once it is needed, as it takes quite some time to import
+        import matplotlib.pyplot as plt
+        from matplotlib.collections import LineCollection
         z_dim = final_labels_zstack.shape[0]
         fig = plt.figure(figsize=(15, 5*z_dim), facecolor='white')
-        gs = fig.add_gridspec(z_dim, 3)
+        axes = fig.subplots(z_dim, 3, sharex='col', sharey='col', squeeze=False)
 
         for plane_index in range(z_dim):
-            fig.add_subplot(gs[plane_index, 0])
-            plt.imshow(preprocessed_zstack[plane_index])
-            plt.ylabel(f'plane_{plane_index}', fontsize=14)
-            if plane_index == 0:
-                plt.title('input image', fontsize=14, pad=15)
-
-        for plane_index in range(z_dim):
-            fig.add_subplot(gs[plane_index, 1])
-            plt.imshow(instance_seg_zstack[plane_index])
-            if plane_index == 0:
-                plt.title('instance segmentation', fontsize=14, pad=15)
-
-        for plane_index in range(z_dim):
-            fig.add_subplot(gs[plane_index, 2])
-            plt.imshow(final_labels_zstack[plane_index], cmap = 'Greys_r')
-            for label_id in plotting_info[plane_index].keys():
-                plt.plot(plotting_info[plane_index][label_id]['boundary_y_coords'], 
-                         plotting_info[plane_index][label_id]['boundary_x_coords'], 
-                         c=plotting_info[plane_index][label_id]['color'], 
-                         lw=3)
+            axes[plane_index, 0].imshow(preprocessed_zstack[plane_index], interpolation='nearest')
+            axes[plane_index, 0].set_ylabel(f'plane_{plane_index}', fontsize=14)
+            axes[plane_index, 1].imshow(instance_seg_zstack[plane_index], interpolation='nearest')
+            axes[plane_index, 2].imshow(final_labels_zstack[plane_index], cmap = 'Greys_r', interpolation='nearest')
+            boundaries = [np.column_stack([label_info['boundary_y_coords'], label_info['boundary_x_coords']]) for label_info in plotting_info[plane_index].values()]
+            colors = [label_info['color'] for label_info in plotting_info[plane_index].values()]
+            axes[plane_index, 2].add_collection(LineCollection(boundaries, colors=colors, linewidths=3))
             if plane_index == plane_id_of_interest:
-                plt.plot([185, 215], [200, 200], c='red', lw='3')
-                plt.plot([200, 200], [185, 215], c='red', lw='3')
-            if plane_index == 0:
-                plt.title('connected components (color-coded)', fontsize=14, pad=15)
+                axes[plane_index, 2].plot([185, 215], [200, 200], c='red', lw='3')
+                axes[plane_index, 2].plot([200, 200], [185, 215], c='red', lw='3')
+
+        axes[0, 0].set_title('input image', fontsize=14, pad=15)
+        axes[0, 1].set_title('instance segmentation', fontsize=14, pad=15)
+        axes[0, 2].set_title('connected components (color-coded)', fontsize=14, pad=15)
 
         if save:
             plt.savefig(filepath, dpi=300)
@@ -185,8 +236,56 @@ class InspectReconstructedCells2D(InspectionStrategy):
         if show:
             plt.show()
         else:
-            plt.close()        
+            plt.close()
+
+    
+    def save_reconstructed_cells_as_image(self, preprocessed_zstack: np.ndarray, instance_seg_zstack: np.ndarray, 
+                                          final_labels_zstack: np.ndarray, plotting_info: Dict, plane_id_of_interest: int, 
+                                          filepath: Path) -> None:
+        # headless alternative to plot_reconstructed_cells: composes the same panels directly as RGB image, without matplotlib figures
+        rows = list()
+        for plane_index in range(final_labels_zstack.shape[0]):
+            preprocessed_panel = self.convert_to_rgb_image(image = preprocessed_zstack[plane_index])
+            instance_seg_panel = self.convert_to_rgb_image(image = instance_seg_zstack[plane_index])
+            final_labels_panel = self.convert_to_rgb_image(image = final_labels_zstack[plane_index], cmap_name = 'Greys_r')
+            for label_info in plotting_info[plane_index].values():
+                bounding_box, boundary_mask = self.get_boundary_mask(boundary_x_coords = label_info['boundary_x_coords'],
+                                                                     boundary_y_coords = label_info['boundary_y_coords'],
+                                                                     shape = final_labels_panel.shape[:2])
+                final_labels_panel[bounding_box][boundary_mask] = np.round(np.asarray(label_info['color'][:3]) * 255)
+            if plane_index == plane_id_of_interest:
+                # slicing (instead of indexing) clips the marker to the panel, if the cropped window is smaller than 400 x 400 px
+                final_labels_panel[199:202, 185:216] = [255, 0, 0]
+                final_labels_panel[185:216, 199:202] = [255, 0, 0]
+            rows.append(np.hstack([preprocessed_panel, instance_seg_panel, final_labels_panel]))
+        imsave(filepath, np.vstack(rows), check_contrast=False)
+        print(f'The resulting plot was successfully saved to: {filepath}')
+        
         
+    def get_boundary_mask(self, boundary_x_coords: np.ndarray, boundary_y_coords: np.ndarray, 
+                          shape: Tuple[int, int], line_width: int=3) -> Tuple[Tuple[slice, slice], np.ndarray]:
+        # returns the boundary (drawn with line_width) as mask within its bounding box, to avoid operations on the entire panel
+        rows, cols = draw.polygon_perimeter(np.round(boundary_x_coords), np.round(boundary_y_coords), shape = shape)
+        margin = line_width // 2
+        min_row, max_row = max(rows.min() - margin, 0), min(rows.max() + margin + 1, shape[0])
+        min_col, max_col = max(cols.min() - margin, 0), min(cols.max() + margin + 1, shape[1])
+        boundary_mask = np.zeros((max_row - min_row, max_col - min_col), dtype=bool)
+        boundary_mask[rows - min_row, cols - min_col] = True
+        boundary_mask = binary_dilation(boundary_mask, structure = np.ones((line_width, line_width), dtype=bool))
+        return (slice(min_row, max_row), slice(min_col, max_col)), boundary_mask
+        
+        
+    def convert_to_rgb_image(self, image: np.ndarray, cmap_name: str='viridis') -> np.ndarray:
+        from matplotlib import colormaps
+        if image.ndim == 3:
+            return image[..., :3].astype('uint8')
+        min_value, max_value = image.min(), image.max()
+        if max_value > min_value:
+            normalized_image = (image - min_value) / (max_value - min_value)
+        else:
+            normalized_image = np.zeros(image.shape)
+        return (colormaps[cmap_name](normalized_image)[..., :3] * 255).round(0).astype('uint8')
+
 
 
 
@@ -121,11 +121,8 @@ class ReconstructCellsIn3DFrom2DInstanceLabels(PostprocessingStrategy):
                 previous_plane_info = (plane_idx - 1, 'previous')
                 next_plane_info = (plane_idx + 1, 'next')
             plane = zstack[plane_idx]
-            unique_label_ids = list(np.unique(plane))
-            if 0 in unique_label_ids:
-                unique_label_ids.remove(0)
-            elif 0.0 in unique_label_ids:
-                unique_label_ids.remove(0.0)
+            unique_label_ids = np.unique(plane)
+            unique_label_ids = unique_label_ids[unique_label_ids != 0]
             for label_id in unique_label_ids:
                 roi = get_polygon_from_instance_segmentation(single_plane = zstack[plane_idx], label_id = label_id)
                 roi_area = roi.area
@@ -150,11 +147,8 @@ class ReconstructCellsIn3DFrom2DInstanceLabels(PostprocessingStrategy):
                     if plane_to_compare_info[0] != None:
                         plane_to_compare_idx, plane_indicator = plane_to_compare_info[0], plane_to_compare_info[1]
                         labels_of_pixels_in_plane_to_compare = zstack[plane_to_compare_idx][np.where(plane == label_id)]
-                        labels_of_pixels_in_plane_to_compare = list(np.unique(labels_of_pixels_in_plane_to_compare))
-                        if 0 in labels_of_pixels_in_plane_to_compare:
-                            labels_of_pixels_in_plane_to_compare.remove(0)
-                        elif 0.0 in labels_of_pixels_in_plane_to_compare:
-                            labels_of_pixels_in_plane_to_compare.remove(0.0)
+                        labels_of_pixels_in_plane_to_compare = np.unique(labels_of_pixels_in_plane_to_compare)
+                        labels_of_pixels_in_plane_to_compare = labels_of_pixels_in_plane_to_compare[labels_of_pixels_in_plane_to_compare != 0]
                         for label_id_in_plane_to_compare in labels_of_pixels_in_plane_to_compare:
                             roi_to_compare = get_polygon_from_instance_segmentation(single_plane = zstack[plane_to_compare_idx], label_id = label_id_in_plane_to_compare)
                             results[plane_idx][label_id] = self.roi_matching(original_roi = roi, 
@@ -365,14 +359,12 @@ class ApplyExclusionCriteria(PostprocessingStrategy):
 
     
     def get_instance_label_info(self, postprocessing_object: PostprocessingObject) -> Dict:
-        instance_label_ids = list(np.unique(postprocessing_object.postprocessed_segmentations))
-        for background_label in [0, 0.0]:
-            if background_label in instance_label_ids:
-                instance_label_ids.remove(background_label)
+        instance_label_ids = np.unique(postprocessing_object.postprocessed_segmentations)
+        instance_label_ids = instance_label_ids[instance_label_ids != 0]
         instance_label_info = dict()
         for label_id in instance_label_ids:
             instance_label_info[label_id] = dict()
-            plane_indices_with_label_id = list(set(np.where(postprocessing_object.postprocessed_segmentations == label_id)[0]))
+            plane_indices_with_label_id = list(np.flatnonzero(np.any(postprocessing_object.postprocessed_segmentations == label_id, axis = (1, 2))))
             instance_label_info[label_id]['plane_indices_with_label_id'] = plane_indices_with_label_id
             instance_label_info[label_id]['max_roi_area'] = self.get_max_roi_area(zstack = postprocessing_object.postprocessed_segmentations,
                                                                                   label_id = label_id,
@@ -1,11 +1,11 @@
 import numpy as np
 import os
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from skimage.io import imread
 from skimage import measure
 from shapely.geometry import Polygon
 from shapely.validation import make_valid
-import matplotlib.pyplot as plt
 from typing import List, Tuple, Dict, Optional
 
 
@@ -37,7 +37,7 @@ def convert_12_to_8_bit_rgb_image(rgb_image: np.ndarray) -> np.ndarray:
 
 def load_zstack_as_array_from_single_planes(path: Path, file_id: str, 
                                             minx: Optional[int]=None, maxx: Optional[int]=None, 
-                                            miny: Optional[int]=None, maxy: Optional[int]=None) -> np.ndarray:
+                                            miny: Optional[int]=None, maxy: Optional[int]=None, max_workers: int=8) -> np.ndarray:
     types = list(set([type(minx), type(maxx), type(miny), type(maxy)]))    
     if any([minx, maxx, miny, maxy]):
         if (len(types) == 1) & (types[0] == int):
@@ -47,16 +47,30 @@ def load_zstack_as_array_from_single_planes(path: Path, file_id: str,
     else:
         cropping = False
     filenames = [filename for filename in listdir_nohidden(path) if filename.startswith(file_id)]
-    cropped_zstack = list()
-    for single_plane_filename in filenames:
+    
+    def load_single_plane(single_plane_filename: str) -> np.ndarray:
         tmp_image = imread(path.joinpath(single_plane_filename))
         if cropping:
-            tmp_image = tmp_image[minx:maxx, miny:maxy]
-        cropped_zstack.append(tmp_image.copy())
-        del tmp_image
+            tmp_image = tmp_image[minx:maxx, miny:maxy].copy()
+        return tmp_image
+    
+    if max_workers > 1:
+        with ThreadPoolExecutor(max_workers = max_workers) as executor:
+            cropped_zstack = list(executor.map(load_single_plane, filenames))
+    else:
+        cropped_zstack = [load_single_plane(single_plane_filename) for single_plane_filename in filenames]
     return np.asarray(cropped_zstack) 
 
 
+def get_label_counts_per_plane(zstack: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # label ids are small non-negative integers, so counting them per plane avoids the sort of np.unique
+    max_label_id = int(zstack.max())
+    label_counts_per_plane = np.stack([np.bincount(plane.ravel(), minlength = max_label_id + 1) for plane in zstack])
+    label_ids = np.flatnonzero(label_counts_per_plane.any(axis = 0))
+    label_ids = label_ids[label_ids != 0]
+    return label_ids, label_counts_per_plane[:, label_ids]
+
+
 def unpad_x_y_dims_in_2d_array(padded_2d_array: np.ndarray, pad_width: int) -> np.ndarray:
     return padded_2d_array[pad_width:padded_2d_array.shape[0]-pad_width, pad_width:padded_2d_array.shape[1]-pad_width]
     
@@ -66,10 +80,12 @@ def unpad_x_y_dims_in_3d_array(padded_3d_array: np.ndarray, pad_width: int) -> n
 
 
 def get_polygon_from_instance_segmentation(single_plane: np.ndarray, label_id: int) -> Polygon:
-    x_dim, y_dim = single_plane.shape
-    tmp_array = np.zeros((x_dim, y_dim), dtype='uint8')
-    tmp_array[np.where(single_plane == label_id)] = 1
-    tmp_contours = measure.find_contours(tmp_array, level = 0)[0]
+    # contours are only traced within the bounding box of label_id (plus 1 px margin) - same result as in the entire plane
+    label_mask = single_plane == label_id
+    rows, cols = np.flatnonzero(label_mask.any(axis = 1)), np.flatnonzero(label_mask.any(axis = 0))
+    min_row, min_col = max(rows[0] - 1, 0), max(cols[0] - 1, 0)
+    tmp_array = label_mask[min_row:rows[-1] + 2, min_col:cols[-1] + 2].astype('uint8')
+    tmp_contours = measure.find_contours(tmp_array, level = 0)[0] + [min_row, min_col]
     roi = Polygon(tmp_contours)
     if roi.is_valid == False:
         roi = make_valid(roi)
@@ -84,8 +100,9 @@ def get_cropping_box_arround_centroid(roi: Polygon, half_window_size: int) -> Tu
 
 
 def get_color_code(label_ids: List, for_rgb: bool=False) -> Dict:
+    from matplotlib import cm
     n_label_ids = len(label_ids)
-    colormixer = plt.cm.rainbow(np.linspace(0, 1, n_label_ids))
+    colormixer = cm.rainbow(np.linspace(0, 1, n_label_ids))
     color_code = dict()
     for idx in range(n_label_ids):
         if for_rgb:
@@ -98,11 +115,8 @@ def get_color_code(label_ids: List, for_rgb: bool=False) -> Dict:
 
 
 def get_rgb_color_code_for_3D(zstack: np.ndarray) -> Dict:
-    label_ids = list(np.unique(zstack))
-    if 0 in label_ids:
-        label_ids.remove(0)
-    if 0.0 in label_ids:
-        label_ids.remove(0)
+    label_ids = np.unique(zstack)
+    label_ids = label_ids[label_ids != 0]
     color_code = get_color_code(label_ids, for_rgb=True)
 
     red_colors = np.zeros(zstack.shape)